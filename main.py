@@ -1,7 +1,8 @@
-# main.py - 修正版本 (使用 Sheets 作為短期 Token 儲存)
+# main.py - 修正版本 (QR Token 改為自帶資訊的短期 JWT，無需伺服器端儲存)
 
 from fastapi import FastAPI, HTTPException, Depends, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from typing import Optional
 import jwt 
@@ -9,9 +10,16 @@ import bcrypt
 import datetime
 import time
 import uuid
+import os
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import anyio
+from cachetools import TTLCache
+from contextlib import asynccontextmanager
 
 # --- 引入 sheets_manager (只引入類和定義，不立即實例化) ---
-from sheets_manager import SheetsManager, WORKSHEET_DEFINITIONS 
+from sheets_manager import SheetsManager, WORKSHEET_DEFINITIONS, BCRYPT_ROUNDS
 
 
 # --- 實例化 SheetsManager (在程式啟動時只執行一次) ---
@@ -31,9 +39,22 @@ INIT_MASTER_KEY = "your_super_secret_init_key"
 QR_CODE_EXP_SECONDS = 15 # QR Code 憑證有效時間
 ADMIN_SESSION_EXP_MINUTES = 60 * 24 
 PARTICIPANT_SESSION_EXP_DAYS = 7 # 學員 Token 有效期 7 天
+THREADPOOL_SIZE = 200 # 🆕 同步路由的 threadpool 上限 (anyio 預設 40，Sheets I/O 每次阻塞 100-500 ms)
+ATTENDANCE_INDEX_REFRESH_INTERVAL_SECONDS = 30 # 🆕 從 Attendance_Log 重建已報到索引的間隔
+ATTENDANCE_EXPORT_INTERVAL_SECONDS = 5 # 🆕 本地報到日誌批次匯出到 Attendance_Log 的間隔
+
+# --- 🆕 已使用的 QR Token ID (jti) 快取，實現一次性使用 ---
+# QR Token 本身是簽章過的 JWT (有效性與到期由簽章驗證)，只需記住已消費的 jti 直到 Token 過期；
+# TTL 多留 5 秒緩衝，確保 jti 在 Token 過期前不會被淘汰。
+# ⚠️ 僅限單一 worker 程序共用，多 worker 部署時同一 Token 仍可能在不同 worker 各被使用一次。
+CONSUMED_QR_TOKEN_IDS = TTLCache(maxsize=100_000, ttl=QR_CODE_EXP_SECONDS + 5)
+CONSUMED_QR_TOKEN_IDS_LOCK = threading.Lock() # TTLCache 非執行緒安全，路由在 threadpool 中執行
+# --------------------------------------------------
 
-# --- ⚠️ 移除 全局記憶體快取：已改用 Google Sheets ---
-# QR_CODE_CACHE = {} 
+# --- 🆕 bcrypt 專用執行緒池 ---
+# bcrypt 每次約 200-300 ms CPU，且執行時會釋放 GIL，執行緒即可平行使用多核心；
+# 以 CPU 核心數為上限，避免雜湊運算佔滿處理 Sheets I/O 的 threadpool
+PASSWORD_HASH_EXECUTOR = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="bcrypt")
 # --------------------------------------------------
 
 
@@ -68,8 +89,52 @@ class ParticipantLoginRequest(BaseModel):
     password: str
 
 
+# --- 🆕 背景任務：定期從 Attendance_Log 重建已報到索引 ---
+# 多 worker 部署時各程序的索引只含自己寫入的記錄，需定期重建才能擋下跨 worker 的重複報到
+# (兩次重建之間仍有短暫空窗)；在 Sheets 中手動刪除的報到記錄也會在重建後失效。
+async def periodic_attendance_index_refresh():
+    while True:
+        await asyncio.sleep(ATTENDANCE_INDEX_REFRESH_INTERVAL_SECONDS)
+        if sheets_manager_instance is None or not sheets_manager_instance.is_connected:
+            continue
+        await run_in_threadpool(sheets_manager_instance.refresh_attendance_index)
+# -------------------------
+
+
+# --- 🆕 背景任務：定期將本地日誌中的報到記錄批次匯出到 Attendance_Log ---
+# 報到在寫入本地 SQLite 日誌後即確認，Sheets 寫入由此任務合併為單一 values.append，
+# 每 ATTENDANCE_EXPORT_INTERVAL_SECONDS 秒最多 1 次寫入；Sheets 無法連線時記錄留在日誌中待下次匯出。
+async def periodic_attendance_export():
+    while True:
+        await asyncio.sleep(ATTENDANCE_EXPORT_INTERVAL_SECONDS)
+        if sheets_manager_instance is None or not sheets_manager_instance.is_connected:
+            continue
+        await run_in_threadpool(sheets_manager_instance.export_attendance_log)
+# -------------------------
+
+
+# --- 🆕 應用程式生命週期：啟動時設定 threadpool 並啟動背景任務，關閉時停止任務並匯出剩餘的報到記錄 ---
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 放大 threadpool，避免併發掃碼時同步路由排隊等待
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    background_tasks = [
+        asyncio.create_task(periodic_attendance_index_refresh()),
+        asyncio.create_task(periodic_attendance_export()),
+    ]
+    try:
+        yield
+    finally:
+        for task in background_tasks:
+            task.cancel()
+        # 未能匯出的記錄仍保留在本地日誌，下次啟動時匯出
+        if sheets_manager_instance is not None:
+            await run_in_threadpool(sheets_manager_instance.export_attendance_log)
+# -------------------------
+
+
 # --- FastAPI 應用程式實例化 ---
-app = FastAPI(title="會議報到系統 API 後端", version="1.0.0")
+app = FastAPI(title="會議報到系統 API 後端", version="1.0.0", lifespan=lifespan)
 
 
 # --- 新增: CORS 配置 ---
@@ -88,7 +153,8 @@ app.add_middleware(
 def get_sheets_manager():
     """依賴注入函數：確保 sheets_manager_instance 存在且已連線"""
     global sheets_manager_instance
-    if sheets_manager_instance is None or not sheets_manager_instance.is_connected:
+    # 🆕 啟動時連線失敗不必重啟服務：定期重新嘗試連線
+    if sheets_manager_instance is None or not sheets_manager_instance.ensure_connected():
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE, 
             detail="服務不可用：Google Sheets 後端連線失敗或初始化錯誤"
@@ -102,7 +168,21 @@ def create_jwt_token(data: dict, expires_delta: datetime.timedelta):
     encoded_jwt = jwt.encode(to_encode, JWT_SECRET_KEY, algorithm=JWT_ALGORITHM)
     return encoded_jwt
 
-# 解碼 JWT Token 函數可移除，因為 QR Token 不再使用 JWT，但保留用於 Session Token 驗證 (如果需要)
+async def hash_password(password: str) -> str:
+    """在 bcrypt 執行緒池中產生密碼雜湊，不阻塞事件迴圈"""
+    loop = asyncio.get_running_loop()
+    hashed = await loop.run_in_executor(
+        PASSWORD_HASH_EXECUTOR, bcrypt.hashpw, password.encode('utf-8'), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
+    )
+    return hashed.decode('utf-8')
+
+async def verify_password(password: str, password_hash: str) -> bool:
+    """在 bcrypt 執行緒池中驗證密碼，不阻塞事件迴圈"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        PASSWORD_HASH_EXECUTOR, bcrypt.checkpw, password.encode('utf-8'), password_hash.encode('utf-8')
+    )
+
 def decode_jwt_token(token: str):
     """解碼 JWT Token 並處理過期或無效錯誤"""
     try:
@@ -113,22 +193,6 @@ def decode_jwt_token(token: str):
     except jwt.InvalidTokenError:
         return {"error": "Invalid token"}
 
-def generate_new_participant_id(sheets_manager: SheetsManager):
-    """查找 Participants 表中最大的 ID (Pxxx) 並生成新的 ID"""
-    participants = sheets_manager.get_all_records('Participants')
-    if not participants:
-        return "P001"
-    
-    id_numbers = [int(p['id'][1:]) for p in participants if p.get('id', '').startswith('P')]
-    
-    if not id_numbers:
-        return "P001"
-        
-    max_id_num = max(id_numbers)
-    new_id_num = max_id_num + 1
-    
-    return f"P{new_id_num:03d}"
-
 # --- API 路由區 ---
 
 # 1. 初始化資料庫 API
@@ -154,9 +218,10 @@ def initialize_db(request: InitializationRequest, sheets_manager: SheetsManager
 
 # 2. 管理員登入 API (App A 登入)
 @app.post("/api/v1/auth/admin-login", tags=["Auth"], summary="Admin Login")
-def admin_login(request: AdminLoginRequest, sheets_manager: SheetsManager = Depends(get_sheets_manager)):
+async def admin_login(request: AdminLoginRequest, sheets_manager: SheetsManager = Depends(get_sheets_manager)):
     """管理員登入，成功後返回 Session Token。"""
-    admin_data = sheets_manager.find_admin_by_username(request.username)
+    # async 路由中的 Sheets I/O 需交給 threadpool，bcrypt 則交給專用執行緒池
+    admin_data = await run_in_threadpool(sheets_manager.find_admin_by_username, request.username)
 
     if not admin_data:
         raise HTTPException(status_code=401, detail="用戶名或密碼錯誤")
@@ -164,10 +229,8 @@ def admin_login(request: AdminLoginRequest, sheets_manager: SheetsManager = Depe
     password_hash = admin_data.get('password_hash')
     if not password_hash:
         raise HTTPException(status_code=500, detail="服務器配置錯誤：缺少密碼雜湊")
-        
-    password_hash = password_hash.encode('utf-8')
     
-    if not bcrypt.checkpw(request.password.encode('utf-8'), password_hash):
+    if not await verify_password(request.password, password_hash):
         raise HTTPException(status_code=401, detail="用戶名或密碼錯誤")
 
     # 生成 JWT Session Token
@@ -189,12 +252,12 @@ def admin_login(request: AdminLoginRequest, sheets_manager: SheetsManager = Depe
     }
 
 
-# 3. Token 生成 API (App B 請求 QR Code Token) - 💥 修正使用 Google Sheets
+# 3. Token 生成 API (App B 請求 QR Code Token) - 🆕 改為簽發短期 JWT
 @app.post("/api/v1/attendance/token", tags=["Attendance"], summary="Generate Qr Token")
 def generate_qr_token(request: TokenRequest, sheets_manager: SheetsManager = Depends(get_sheets_manager)):
     """
     參與者App (App B) 請求生成用於報到的 QR Code Token。
-    現在將 Token 儲存到 Google Sheets 以支援擴展。
+    Token 為自帶報到資訊的短期 JWT，伺服器端無需儲存。
     """
     
     # 1. 驗證參與者 ID
@@ -207,50 +270,50 @@ def generate_qr_token(request: TokenRequest, sheets_manager: SheetsManager = Dep
     if not agenda_item:
         raise HTTPException(status_code=404, detail="議程 ID 無效")
 
-    # 3. 🆕 生成一個 UUID 作為短期 Token
-    short_uuid_token = str(uuid.uuid4())
-    
-    # 4. 儲存到 Sheets 中，設置到期時間 (UNIX timestamp)
-    expires_at = int(time.time() + QR_CODE_EXP_SECONDS)
-    
+    # 3. 🆕 簽發短期 JWT：報到資訊與到期時間都在 Token 內 (0 次 Sheets API)
     token_payload = {
-        "token_uuid": short_uuid_token,
+        "jti": uuid.uuid4().hex, # Token 唯一 ID，用於一次性消費
         "participant_id": request.participant_id,
         "agenda_item_id": request.agenda_item_id,
         "device_id": request.device_id,
-        "expires_at": expires_at # 儲存為整數 timestamp
+        "token_type": "qr"
     }
-    
-    sheets_manager.add_qr_token(token_payload) # 🆕 改為寫入 Sheets
+    qr_code_token = create_jwt_token(
+        token_payload,
+        datetime.timedelta(seconds=QR_CODE_EXP_SECONDS)
+    )
 
-    # 5. 返回短 Token 和到期時間
+    # 4. 返回 Token 和到期時間
     return {
         "status": "success",
-        "qr_code_token": short_uuid_token, # 返回 UUID
+        "qr_code_token": qr_code_token,
         "expires_in": QR_CODE_EXP_SECONDS
     }
 
 
-# 4. 報到掃碼 API (App A 核心功能) - 💥 修正使用 Google Sheets
+# 4. 報到掃碼 API (App A 核心功能) - 🆕 驗證 JWT 簽章並記錄已消費的 jti
 @app.post("/api/v1/attendance/check-in", tags=["Attendance"], summary="Check In")
 def check_in(request: CheckInRequest, sheets_manager: SheetsManager = Depends(get_sheets_manager)):
     """
     報到掃碼設備 (App A) 掃描 QR Code 後調用此 API 進行報到。
-    現在是基於 Google Sheets 的查詢和消費。
+    QR Token 由 JWT 簽章驗證，已消費的 jti 記錄在記憶體中；報到記錄仍寫入 Google Sheets。
     """
-    qr_uuid_token = request.qr_code_token
-    
-    # 1. 🆕 從 Sheets 中查找並刪除 Token（實現一次性消費）
-    token_data = sheets_manager.consume_qr_token(qr_uuid_token) 
+    # 1. 🆕 驗證 JWT 簽章與到期時間
+    token_data = decode_jwt_token(request.qr_code_token)
 
-    if not token_data:
+    if token_data.get("error") == "Token expired":
+        raise HTTPException(status_code=400, detail="報到失敗：QR Code 已過期。")
+    if "error" in token_data or token_data.get("token_type") != "qr":
+        # Session Token 使用相同密鑰簽發，必須以 token_type 排除
         raise HTTPException(status_code=400, detail="報到失敗：QR Code 無效或已使用。")
     
-    # 2. 檢查是否過期
-    if time.time() > token_data['expires_at']:
-        raise HTTPException(status_code=400, detail="報到失敗：QR Code 已過期。")
+    # 2. 一次性消費：檢查並記錄 jti (在鎖內完成，避免併發掃描同一 Token)
+    with CONSUMED_QR_TOKEN_IDS_LOCK:
+        if token_data.get("jti") in CONSUMED_QR_TOKEN_IDS:
+            raise HTTPException(status_code=400, detail="報到失敗：QR Code 無效或已使用。")
+        CONSUMED_QR_TOKEN_IDS[token_data.get("jti")] = True
 
-    # 3. 獲取 Token 內含資訊 (從 Sheets 取得)
+    # 3. 獲取 Token 內含資訊 (從 JWT 取得)
     p_id = token_data.get('participant_id')
     a_id_token = token_data.get('agenda_item_id')
     
@@ -260,13 +323,8 @@ def check_in(request: CheckInRequest, sheets_manager: SheetsManager = Depends(ge
     if a_id_token != request.agenda_item_id:
         raise HTTPException(status_code=400, detail="報到失敗：議程 ID 不匹配。")
     
-    # b. 檢查是否已報到 
-    attendance_logs = sheets_manager.get_all_records('Attendance_Log')
-    is_already_checked_in = any(
-        log.get('participant_id') == p_id and log.get('agenda_item_id') == a_id_token 
-        for log in attendance_logs
-    )
-    if is_already_checked_in:
+    # b. 檢查是否已報到 (🆕 查詢記憶體索引，不再下載整張 Attendance_Log)
+    if sheets_manager.has_attended(p_id, a_id_token):
         raise HTTPException(status_code=400, detail="報到失敗：該學員已報到過。")
 
     # 5. 寫入報到記錄
@@ -282,10 +340,16 @@ def check_in(request: CheckInRequest, sheets_manager: SheetsManager = Depends(ge
         "TRUE"
     ]
     
-    sheets_manager.append_row('Attendance_Log', log_data)
+    # mark_attended 在索引中原子地檢查並標記，避免同一學員併發報到寫入兩筆
+    if not sheets_manager.mark_attended(p_id, a_id_token, log_data):
+        raise HTTPException(status_code=400, detail="報到失敗：該學員已報到過。")
     
     # 6. 獲取學員名稱 (用於 App A 顯示)
     participant_data = sheets_manager.find_record_by_id('Participants', p_id, id_column=1)
+    if participant_data is None:
+        # 🆕 其他 worker 剛註冊的學員可能尚未出現在快取中 (p_id 來自已驗證簽章的 Token，可安全地重新讀取)
+        sheets_manager.invalidate_cache('Participants')
+        participant_data = sheets_manager.find_record_by_id('Participants', p_id, id_column=1) or {}
     
     return {
         "status": "success",
@@ -298,25 +362,30 @@ def check_in(request: CheckInRequest, sheets_manager: SheetsManager = Depends(ge
 
 # 5. 參與者註冊 API (App B 流程 #1)
 @app.post("/api/v1/auth/participant-signup", tags=["Auth"], summary="Participant Sign Up")
-def participant_signup(request: ParticipantSignupRequest, sheets_manager: SheetsManager = Depends(get_sheets_manager)):
+async def participant_signup(request: ParticipantSignupRequest, sheets_manager: SheetsManager = Depends(get_sheets_manager)):
     """學員/參與者註冊新帳號。"""
     
     if len(request.password) < 6:
         raise HTTPException(status_code=400, detail="密碼長度至少需要 6 個字符")
 
-    participants = sheets_manager.get_all_records('Participants')
+    try:
+        email_registered = await run_in_threadpool(sheets_manager.is_email_registered, request.email)
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"註冊失敗，無法檢查 Email 是否已註冊: {e}")
+    if email_registered:
+        raise HTTPException(status_code=400, detail="此 Email 已被註冊")
+
+    participants = await run_in_threadpool(sheets_manager.get_all_records, 'Participants')
     for p in participants:
-        if p.get('email') == request.email:
-            raise HTTPException(status_code=400, detail="此 Email 已被註冊")
         if p.get('phone_number') == request.phone_number:
             raise HTTPException(status_code=400, detail="此手機號碼已被註冊")
 
-    hashed_password = bcrypt.hashpw(
-        request.password.encode('utf-8'), 
-        bcrypt.gensalt()
-    ).decode('utf-8')
+    hashed_password = await hash_password(request.password)
     
-    new_id = generate_new_participant_id(sheets_manager)
+    try:
+        new_id = await run_in_threadpool(sheets_manager.generate_new_participant_id)
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"註冊失敗: {e}")
 
     new_row_data = [
         new_id,
@@ -328,7 +397,7 @@ def participant_signup(request: ParticipantSignupRequest, sheets_manager: Sheets
     ]
 
     try:
-        sheets_manager.append_row('Participants', new_row_data)
+        await run_in_threadpool(sheets_manager.add_participant, new_row_data)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"註冊寫入資料庫失敗: {e}")
 
@@ -340,11 +409,11 @@ def participant_signup(request: ParticipantSignupRequest, sheets_manager: Sheets
 
 # 6. 參與者登入 API (App B 流程 #2)
 @app.post("/api/v1/auth/participant-login", tags=["Auth"], summary="Participant Login")
-def participant_login(request: ParticipantLoginRequest, sheets_manager: SheetsManager = Depends(get_sheets_manager)):
+async def participant_login(request: ParticipantLoginRequest, sheets_manager: SheetsManager = Depends(get_sheets_manager)):
     """學員/參與者登入，成功後返回 Session Token。"""
     
-    participants = sheets_manager.get_all_records('Participants')
-    participant_data = next((p for p in participants if p.get('email') == request.email), None)
+    # 🆕 以 Email 索引查找，取代下載整張 Participants 後逐筆比對
+    participant_data = await run_in_threadpool(sheets_manager.find_participant_by_email, request.email)
 
     if not participant_data:
         raise HTTPException(status_code=401, detail="Email 或密碼錯誤")
@@ -352,10 +421,8 @@ def participant_login(request: ParticipantLoginRequest, sheets_manager: SheetsMa
     password_hash = participant_data.get('login_hash')
     if not password_hash:
         raise HTTPException(status_code=500, detail="資料錯誤：參與者密碼雜湊遺失")
-        
-    password_hash = password_hash.encode('utf-8')
     
-    if not bcrypt.checkpw(request.password.encode('utf-8'), password_hash):
+    if not await verify_password(request.password, password_hash):
         raise HTTPException(status_code=401, detail="Email 或密碼錯誤")
 
     # 生成 JWT Session Token (長時間有效)
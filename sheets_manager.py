@@ -1,12 +1,18 @@
 # sheets_manager.py (修訂版，支持 Render 環境變數連線)
 
 import gspread
-from gspread.exceptions import WorksheetNotFound
+import google.auth.exceptions
+from gspread.utils import absolute_range_name, numericise_all, rowcol_to_a1, to_records
+from cachetools import TTLCache
+from requests.adapters import HTTPAdapter
+import requests
 import bcrypt
 import time
 import uuid
 import os 
 import json # 🆕 必須新增: 用於解析環境變數中的 JSON 字串
+import threading
+import sqlite3
 
 # --- 配置 (Config) ---
 # 檔案路徑模式的備用配置 (在 Render 上通常無效，但保留備用)
@@ -15,8 +21,34 @@ SERVICE_ACCOUNT_FILE = os.environ.get(
     'gen-lang-client-0392311291-771068520057.json'
 ) 
 SPREADSHEET_NAME = '會議報到' # 請替換為您的 Google Sheets 名稱
+# 🆕 設定後改用 open_by_key 開啟 (單一 metadata 請求，免去依名稱搜尋 Drive)
+SPREADSHEET_KEY = os.environ.get('SPREADSHEET_KEY')
+SHEETS_CONNECT_ATTEMPTS = 5 # 🆕 啟動時連線重試次數 (僅限暫時性錯誤，指數退避 1, 2, 4, 8... 秒，最長 30 秒)
+SHEETS_RECONNECT_INTERVAL_SECONDS = 30 # 🆕 啟動連線失敗後，請求觸發重新連線的最短間隔
+SHEETS_CACHE_TTL_SECONDS = 30 # 🆕 工作表讀取快取時間，降低 Sheets 每分鐘讀取配額的消耗
+# 🆕 連往 Google API 的 HTTP 連線池大小 (requests 預設僅 10，併發請求時會反覆重建 TLS 連線)
+SHEETS_HTTP_POOL_SIZE = int(os.environ.get('SHEETS_HTTP_POOL_SIZE', '50'))
+# 🆕 bcrypt 成本因子：預設 12 每次約 250 ms，10 約快 4 倍；既有雜湊內含自身成本因子，仍可正常驗證
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', '10'))
+# 🆕 報到記錄的本地 SQLite 日誌：報到先寫入本地 (確認報到前已落地)，再由背景任務批次匯出到 Attendance_Log。
+# 同一主機的多個 worker 共用同一檔案；Render 等環境需指向持久化磁碟才能跨部署保留未匯出的記錄
+ATTENDANCE_JOURNAL_PATH = os.environ.get('ATTENDANCE_JOURNAL_PATH', 'attendance_journal.db')
+ATTENDANCE_JOURNAL_RETENTION_SECONDS = 300 # 🆕 已匯出的記錄保留多久，供同主機 worker 間的重複報到檢查
+ATTENDANCE_EXPORT_CLAIM_SECONDS = 120 # 🆕 匯出認領逾時：認領後程序中斷的記錄，逾時後可由其他 worker 重新匯出
 
 
+def _is_transient_error(e: Exception) -> bool:
+    """🆕 只有配額 (429)、伺服器端 (5xx) 與網路錯誤值得重試；找不到試算表或權限不足重試也不會成功"""
+    if isinstance(e, gspread.exceptions.APIError):
+        status_code = e.response.status_code
+        return status_code == 429 or status_code >= 500
+    # 第一次 API 呼叫會先取得 access token，此時的網路錯誤由 google-auth 包裝為 TransportError
+    if isinstance(e, google.auth.exceptions.TransportError):
+        return True
+    if isinstance(e, google.auth.exceptions.RefreshError):
+        return e.retryable
+    return isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
 # --- 定義所有工作表及其表頭 (Headers) ---
 WORKSHEET_DEFINITIONS = {
     'Admins': ['id', 'username', 'password_hash', 'role', 'last_login'],
@@ -28,6 +60,9 @@ WORKSHEET_DEFINITIONS = {
     # 🆕 新增: 將短期 QR Token 儲存到 Sheets 以支援擴展
     'Qr_Tokens': ['token_uuid', 'participant_id', 'agenda_item_id', 'device_id', 'expires_at']
 }
+PARTICIPANT_EMAIL_COLUMN = WORKSHEET_DEFINITIONS['Participants'].index('email') + 1
+ATTENDANCE_PARTICIPANT_COLUMN = WORKSHEET_DEFINITIONS['Attendance_Log'].index('participant_id') + 1
+ATTENDANCE_AGENDA_COLUMN = WORKSHEET_DEFINITIONS['Attendance_Log'].index('agenda_item_id') + 1
 
 
 class SheetsManager:
@@ -36,6 +71,45 @@ class SheetsManager:
         self.is_connected = False
         self.spreadsheet = None
         self.gc = None
+        self._connect_mode = ""
+        self._worksheets = {} # 🆕 工作表物件快取 {title: Worksheet}
+        
+        # 🆕 已報到索引 {(participant_id, agenda_item_id)}：避免每次報到下載整張 Attendance_Log
+        self._attended = set()
+        self._attended_loaded = False # 索引載入失敗時，has_attended 改為直接查詢 Sheets
+        self._attended_lock = threading.Lock()
+        # 🆕 本程序最近標記的報到 {key: 標記時間}，重建索引時保留讀取結果中可能尚未出現的記錄
+        self._recent_marks = {}
+        # 🆕 報到記錄的本地日誌 (SQLite)，無法開啟時退回為報到時直接寫入 Sheets
+        self._journal = None
+        self._journal_lock = threading.Lock()
+        try:
+            self._journal = self._open_journal(ATTENDANCE_JOURNAL_PATH)
+        except Exception as e:
+            print(f"警告：無法開啟報到日誌 {ATTENDANCE_JOURNAL_PATH}，報到將直接寫入 Sheets: {e}")
+        
+        # 🆕 本程序最後發出的學員 ID 編號 (Pxxx)，避免同一程序的併發註冊在寫入前拿到相同 ID
+        self._max_participant_id = 0
+        self._participant_id_lock = threading.Lock()
+        
+        # 🆕 剛註冊的學員 {email: 學員記錄}：只保留 SHEETS_CACHE_TTL_SECONDS 秒，
+        # 涵蓋 Participants 快取尚未包含新寫入資料的空窗，之後一律以 Sheets 內容為準
+        self._recent_signups = TTLCache(maxsize=10_000, ttl=SHEETS_CACHE_TTL_SECONDS)
+        self._participants_lock = threading.Lock()
+        
+        # 🆕 工作表內容快取 {sheet_name: get_all_values()}，寫入時失效
+        self._values_cache = TTLCache(maxsize=32, ttl=SHEETS_CACHE_TTL_SECONDS)
+        # 🆕 快取世代 {sheet_name: 失效次數} 與全部失效次數：讀取期間若快取被失效，讀取結果不寫回快取
+        self._cache_generations = {}
+        self._cache_epoch = 0
+        # 🆕 ID 索引快取 {(sheet_name, id_column): (建立索引所用的內容, {id: record})}，
+        # 只在內容快取仍是同一份資料時沿用，因此不會比內容快取更舊
+        self._index_cache = {}
+        self._cache_lock = threading.Lock()
+        
+        # 🆕 連線失敗後的重新連線控制
+        self._connect_lock = threading.Lock()
+        self._last_connect_attempt = 0.0
         
         # 🆕 關鍵：從 Render 環境變數 GSPREAD_SECRET 讀取 JSON 內容
         gspread_secret_json = os.environ.get('GSPREAD_SECRET')
@@ -45,39 +119,267 @@ class SheetsManager:
             try:
                 credentials = json.loads(gspread_secret_json)
                 self.gc = gspread.service_account_from_dict(credentials) 
-                self.spreadsheet = self.gc.open(SPREADSHEET_NAME)
-                self.is_connected = True
-                print("SheetsManager 連接成功 (使用環境變數 GSPREAD_SECRET)。")
+                self._configure_http_pool()
+                self._connect_mode = "使用環境變數 GSPREAD_SECRET"
             except Exception as e:
                 print(f"警告：Google Sheets 連接失敗 (環境變數模式)。請檢查 GSPREAD_SECRET 變數或金鑰內容: {e}")
         else:
             # 如果沒有 GSPREAD_SECRET，則嘗試使用舊的檔案路徑模式
             try:
                 self.gc = gspread.service_account(filename=SERVICE_ACCOUNT_FILE)
-                self.spreadsheet = self.gc.open(SPREADSHEET_NAME)
-                self.is_connected = True
-                print("SheetsManager 連接成功 (使用備用檔案路徑模式)。")
+                self._configure_http_pool()
+                self._connect_mode = "使用備用檔案路徑模式"
             except Exception as e:
                 # 連線失敗的具體錯誤在這裡，導致 main.py 拋出 503
                 print(f"警告：Google Sheets 連接失敗。路由已載入，但所有 API 將返回 503 錯誤：{e}")
+        
+        # 憑證載入成功後才開啟試算表；網路或 API 暫時性錯誤以指數退避重試
+        if self.gc is not None:
+            self._connect(attempts=SHEETS_CONNECT_ATTEMPTS)
                 
+    def _connect(self, attempts: int = 1):
+        """開啟試算表並載入工作表與記憶體索引，暫時性錯誤以指數退避重試；不會拋出例外"""
+        for attempt in range(1, attempts + 1):
+            self._last_connect_attempt = time.time()
+            try:
+                if SPREADSHEET_KEY:
+                    self.spreadsheet = self.gc.open_by_key(SPREADSHEET_KEY)
+                else:
+                    self.spreadsheet = self.gc.open(SPREADSHEET_NAME)
+                self._refresh_worksheets()
+                # 索引載入完成後才標記為已連線，避免請求在載入期間以空索引處理 (載入期間 get_worksheet 已可使用)
+                self._load_indexes()
+                self.is_connected = True
+                print(f"SheetsManager 連接成功 ({self._connect_mode})。")
+                return
+            except Exception as e:
+                self._worksheets = {}
+                if attempt == attempts or not _is_transient_error(e):
+                    print(f"警告：Google Sheets 連接失敗。路由已載入，但所有 API 將返回 503 錯誤：{e}")
+                    return
+                delay = min(2 ** (attempt - 1), 30)
+                print(f"Google Sheets 連接失敗 (第 {attempt}/{attempts} 次)，{delay} 秒後重試：{e}")
+                time.sleep(delay)
+
+    def ensure_connected(self):
+        """若啟動時連線失敗，於請求時重新嘗試連線 (每 SHEETS_RECONNECT_INTERVAL_SECONDS 秒最多一次)"""
+        if self.is_connected or self.gc is None:
+            return self.is_connected
+        with self._connect_lock:
+            if not self.is_connected and time.time() - self._last_connect_attempt >= SHEETS_RECONNECT_INTERVAL_SECONDS:
+                self._connect()
+        return self.is_connected
+
+    def _configure_http_pool(self):
+        """為 gspread 的 AuthorizedSession 掛載較大的連線池，讓併發請求重用連線"""
+        # pool_block=True：併發數超過連線池時等待空閒連線，而不是另開用完即丟的連線
+        # (threadpool 可達 THREADPOOL_SIZE 個執行緒，遠大於連線池，否則每個溢出請求都要重新 TLS 握手)
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=SHEETS_HTTP_POOL_SIZE, pool_block=True)
+        self.gc.http_client.session.mount('https://', adapter)
+
+    def _load_indexes(self):
+        """啟動時讀取 Attendance_Log，建立已報到記憶體索引"""
+        self.refresh_attendance_index()
+
+    @staticmethod
+    def _open_journal(path: str):
+        """開啟 (必要時建立) 報到日誌；isolation_level=None 以便自行控制交易範圍"""
+        journal = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        journal.execute("PRAGMA journal_mode=WAL")
+        journal.execute("PRAGMA synchronous=FULL") # 每次提交都 fsync，確認報到前記錄已寫入磁碟
+        journal.execute("""
+            CREATE TABLE IF NOT EXISTS attendance_journal (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                participant_id TEXT NOT NULL,
+                agenda_item_id TEXT NOT NULL,
+                row_json TEXT NOT NULL,
+                journaled_at REAL NOT NULL,
+                exported INTEGER NOT NULL DEFAULT 0,
+                claim_id TEXT,
+                claimed_at REAL
+            )
+        """)
+        journal.execute(
+            "CREATE INDEX IF NOT EXISTS attendance_journal_key ON attendance_journal (participant_id, agenda_item_id)"
+        )
+        return journal
+
+    def _journal_attendance(self, key: tuple, log_data: list) -> bool:
+        """在單一交易中檢查並寫入報到日誌；同主機其他 worker 已記錄同一報到時返回 False"""
+        with self._journal_lock:
+            # BEGIN IMMEDIATE 取得寫入鎖，跨程序的檢查與寫入才是原子的
+            self._journal.execute("BEGIN IMMEDIATE")
+            try:
+                duplicate = self._journal.execute(
+                    "SELECT 1 FROM attendance_journal WHERE participant_id = ? AND agenda_item_id = ? "
+                    "AND (exported = 0 OR journaled_at >= ?) LIMIT 1",
+                    (*key, time.time() - ATTENDANCE_JOURNAL_RETENTION_SECONDS)
+                ).fetchone()
+                if duplicate:
+                    self._journal.execute("ROLLBACK")
+                    return False
+                self._journal.execute(
+                    "INSERT INTO attendance_journal (participant_id, agenda_item_id, row_json, journaled_at) VALUES (?, ?, ?, ?)",
+                    (*key, json.dumps(log_data, ensure_ascii=False), time.time())
+                )
+                self._journal.execute("COMMIT")
+            except Exception:
+                if self._journal.in_transaction:
+                    self._journal.execute("ROLLBACK")
+                raise
+        return True
+
+    def _journal_keys(self):
+        """報到日誌中尚未匯出或仍在保留期內的 {(participant_id, agenda_item_id)}"""
+        if self._journal is None:
+            return set()
+        with self._journal_lock:
+            rows = self._journal.execute(
+                "SELECT participant_id, agenda_item_id FROM attendance_journal WHERE exported = 0 OR journaled_at >= ?",
+                (time.time() - ATTENDANCE_JOURNAL_RETENTION_SECONDS,)
+            ).fetchall()
+        return set(rows)
+
+    def export_attendance_log(self):
+        """以單一 values.append 將日誌中尚未匯出的報到記錄寫入 Attendance_Log，返回匯出筆數；失敗時留待下次重試"""
+        if self._journal is None or not self.is_connected:
+            return 0
+        claim_id = uuid.uuid4().hex
+        now = time.time()
+        with self._journal_lock:
+            # 先認領再匯出，同主機多個 worker 不會重複匯出同一筆；認領逾時的記錄 (匯出中程序中斷) 可重新認領
+            self._journal.execute(
+                "UPDATE attendance_journal SET claim_id = ?, claimed_at = ? "
+                "WHERE exported = 0 AND (claim_id IS NULL OR claimed_at < ?)",
+                (claim_id, now, now - ATTENDANCE_EXPORT_CLAIM_SECONDS)
+            )
+            rows = [
+                json.loads(row_json) for (row_json,) in self._journal.execute(
+                    "SELECT row_json FROM attendance_journal WHERE claim_id = ? AND exported = 0 ORDER BY seq",
+                    (claim_id,)
+                )
+            ]
+        if not rows:
+            return 0
+        try:
+            self._append_values('Attendance_Log', rows)
+        except Exception as e:
+            print(f"匯出 Attendance_Log 失敗，{len(rows)} 筆記錄保留在本地日誌，下次重試: {e}")
+            with self._journal_lock:
+                self._journal.execute("UPDATE attendance_journal SET claim_id = NULL WHERE claim_id = ?", (claim_id,))
+            return 0
+        finally:
+            self.invalidate_cache('Attendance_Log')
+        with self._journal_lock:
+            self._journal.execute("UPDATE attendance_journal SET exported = 1 WHERE claim_id = ?", (claim_id,))
+            self._journal.execute(
+                "DELETE FROM attendance_journal WHERE exported = 1 AND journaled_at < ?",
+                (now - ATTENDANCE_JOURNAL_RETENTION_SECONDS,)
+            )
+        return len(rows)
+
+    def refresh_attendance_index(self):
+        """從 Attendance_Log 重建已報到索引 (經由內容快取)，由背景任務定期呼叫，返回是否成功
+
+        重建可納入其他 worker 寫入的報到記錄，並移除在 Sheets 中被手動刪除的記錄。
+        """
+        try:
+            # 直接使用原始儲存格值：get_all_records 會把數字字串轉為 int，與 Token 中的 ID 比對不到
+            values = self._get_all_values('Attendance_Log')
+        except Exception as e:
+            print(f"讀取 Attendance_Log 失敗，沿用現有報到索引 (未載入時改為逐筆查詢 Sheets): {e}")
+            return False
+        attended = {
+            (row[ATTENDANCE_PARTICIPANT_COLUMN - 1], row[ATTENDANCE_AGENDA_COLUMN - 1])
+            for row in values[1:]
+            if len(row) >= ATTENDANCE_AGENDA_COLUMN
+        }
+        # 納入本地日誌中尚未匯出的記錄 (含同主機其他 worker 與重啟前留下的記錄)
+        try:
+            attended |= self._journal_keys()
+        except Exception as e:
+            print(f"讀取報到日誌失敗: {e}")
+        with self._attended_lock:
+            # 內容快取最長 SHEETS_CACHE_TTL_SECONDS 秒，讀取結果可能早於本程序剛寫入的記錄
+            cutoff = time.time() - 2 * SHEETS_CACHE_TTL_SECONDS
+            self._recent_marks = {key: t for key, t in self._recent_marks.items() if t >= cutoff}
+            self._attended = attended | self._recent_marks.keys()
+            self._attended_loaded = True
+        return True
+
+    def _refresh_worksheets(self):
+        """一次取得所有工作表物件並快取 (1 次 API)，之後 get_worksheet 不再查詢 metadata"""
+        self._worksheets = {ws.title: ws for ws in self.spreadsheet.worksheets()}
+
     def get_worksheet(self, title: str):
         """獲取指定名稱的工作表對象"""
-        if not self.is_connected:
+        # 以工作表快取判斷而非 is_connected：連線過程中載入索引時即需讀取工作表
+        if not self._worksheets:
              raise Exception("Google Sheets 服務未連接。")
         try:
-            return self.spreadsheet.worksheet(title)
-        except WorksheetNotFound:
+            return self._worksheets[title]
+        except KeyError:
             raise Exception(f"找不到工作表: {title}")
 
+    def _get_all_values(self, sheet_name: str):
+        """讀取工作表的所有儲存格數據 (含表頭)，結果快取 SHEETS_CACHE_TTL_SECONDS 秒"""
+        with self._cache_lock:
+            values = self._values_cache.get(sheet_name)
+            generation = self._cache_generation(sheet_name)
+        if values is None:
+            values = self.get_worksheet(sheet_name).get_all_values()
+            with self._cache_lock:
+                # 讀取開始後若有寫入使快取失效，這份結果可能早於寫入，只回傳不快取
+                if self._cache_generation(sheet_name) == generation:
+                    self._values_cache[sheet_name] = values
+        return values
+
+    def _cache_generation(self, sheet_name: str):
+        """目前的快取世代 (需在 _cache_lock 內呼叫)"""
+        return (self._cache_epoch, self._cache_generations.get(sheet_name, 0))
+
+    def _get_index(self, sheet_name: str, id_column: int):
+        """以指定欄位為鍵建立 {id: 記錄} 索引 (與 find 相同，重複 ID 取第一筆)"""
+        key = (sheet_name, id_column)
+        values = self._get_all_values(sheet_name)
+        with self._cache_lock:
+            cached = self._index_cache.get(key)
+        if cached is not None and cached[0] is values:
+            return cached[1]
+        index = {}
+        if values:
+            headers = values[0]
+            for row in values[1:]:
+                if len(row) >= id_column and row[id_column - 1] not in index:
+                    index[row[id_column - 1]] = dict(zip(headers, row))
+        with self._cache_lock:
+            self._index_cache[key] = (values, index)
+        return index
+
+    def invalidate_cache(self, sheet_name: str = None):
+        """讓指定工作表 (未指定則全部) 的讀取快取失效"""
+        with self._cache_lock:
+            if sheet_name is None:
+                self._cache_epoch += 1
+                self._values_cache.clear()
+                self._index_cache.clear()
+            else:
+                self._cache_generations[sheet_name] = self._cache_generations.get(sheet_name, 0) + 1
+                self._values_cache.pop(sheet_name, None)
+                for key in [k for k in self._index_cache.keys() if k[0] == sheet_name]:
+                    self._index_cache.pop(key, None)
+
     def get_all_records(self, sheet_name: str):
         """讀取工作表的所有記錄（以字典列表形式）"""
         if not self.is_connected:
              # 如果未連接，返回空列表以避免 main.py 邏輯崩潰
              return [] 
         try:
-            sheet = self.get_worksheet(sheet_name)
-            return sheet.get_all_records()
+            values = self._get_all_values(sheet_name)
+            if not values:
+                return []
+            # 與 gspread 的 get_all_records 相同：數值字串轉為數字
+            return to_records(values[0], [numericise_all(row) for row in values[1:]])
         except Exception as e:
             print(f"讀取 {sheet_name} 失敗: {e}")
             return []
@@ -87,15 +389,8 @@ class SheetsManager:
         if not self.is_connected:
             return None
         try:
-            sheet = self.get_worksheet(sheet_name)
-            # gspread 查找：找到 ID 欄位中匹配的第一行
-            cell = sheet.find(record_id, in_column=id_column)
-            # 獲取該行所有數據
-            row_values = sheet.row_values(cell.row)
-            headers = sheet.row_values(1)
-            return dict(zip(headers, row_values))
-        except gspread.exceptions.CellNotFound:
-            return None
+            # 🆕 從快取的 ID 索引查找 (快取命中時 0 次 API)，取代 find + row_values × 2
+            return self._get_index(sheet_name, id_column).get(record_id)
         except Exception as e:
             print(f"查找失敗: {e}")
             return None
@@ -111,80 +406,149 @@ class SheetsManager:
             return None
             
         try:
-            sheet = self.get_worksheet('Admins')
-            cell = sheet.find(username, in_column=2) 
-            row_values = sheet.row_values(cell.row)
-            headers = sheet.row_values(1)
-            return dict(zip(headers, row_values))
-        except gspread.exceptions.CellNotFound:
-            return None
+            # 🆕 從快取的 username 索引查找 (快取命中時 0 次 API)，取代 find + row_values × 2
+            return self._get_index('Admins', 2).get(username)
         except Exception as e:
             print(f"查找管理員失敗: {e}")
             return None
             
+    def _append_values(self, sheet_name: str, rows: list):
+        """以單一 values.append 請求寫入 (RAW 不解析公式；INSERT_ROWS 插入新行而非覆寫表格下方的儲存格)"""
+        self.spreadsheet.values_append(
+            absolute_range_name(sheet_name, 'A1'),
+            params={"valueInputOption": "RAW", "insertDataOption": "INSERT_ROWS"},
+            body={"values": rows}
+        )
+
     def append_row(self, sheet_name: str, data: list):
         """在工作表末尾新增一行數據"""
         if not self.is_connected:
              print(f"模擬寫入 {sheet_name}: {data} (服務未連接)")
              return True # 模擬成功寫入
         try:
-            sheet = self.get_worksheet(sheet_name)
-            sheet.append_row(data)
+            self._append_values(sheet_name, [data])
         except Exception as e:
             print(f"寫入 {sheet_name} 失敗: {e}")
             raise 
+        finally:
+            self.invalidate_cache(sheet_name)
             
-    # 🆕 Token 相關方法:
-    def add_qr_token(self, token_data: dict):
-        """新增一個 QR Token 記錄到 Qr_Tokens 表。"""
-        if not self.is_connected:
-             print(f"模擬寫入 Qr_Tokens: {token_data}")
-             return True
-        try:
-            sheet = self.get_worksheet('Qr_Tokens')
-            # 確保數據順序與表頭 ['token_uuid', 'participant_id', 'agenda_item_id', 'device_id', 'expires_at'] 一致
-            data = [
-                token_data['token_uuid'],
-                token_data['participant_id'],
-                token_data['agenda_item_id'],
-                token_data['device_id'],
-                token_data['expires_at'] # 儲存 UNIX timestamp
-            ]
-            sheet.append_row(data)
+    def is_email_registered(self, email: str) -> bool:
+        """註冊前檢查 Email 是否已使用：直接讀取 Email 欄 (不經快取，1 次 API)；讀取失敗時拋出例外"""
+        # 快取不含其他 worker 剛註冊的學員，以快取判斷會讓同一 Email 在不同 worker 重複註冊
+        email_col = rowcol_to_a1(1, PARTICIPANT_EMAIL_COLUMN)[:-1]
+        column = self.spreadsheet.values_get(
+            absolute_range_name('Participants', f"{email_col}:{email_col}")
+        ).get('values', [])
+        if any(row and row[0] == email for row in column[1:]):
             return True
+        with self._participants_lock:
+            return email in self._recent_signups
+
+    def find_participant_by_email(self, email: str):
+        """根據 Email 查找學員 (查詢 Participants 索引快取，命中時 0 次 API 呼叫，每 SHEETS_CACHE_TTL_SECONDS 秒更新)"""
+        participant = None
+        if self.is_connected:
+            try:
+                participant = self._get_index('Participants', PARTICIPANT_EMAIL_COLUMN).get(email)
+            except Exception as e:
+                print(f"查找學員失敗: {e}")
+        if participant is None:
+            # 剛註冊的學員可能尚未出現在快取的 Participants 內容中
+            with self._participants_lock:
+                participant = self._recent_signups.get(email)
+        return participant
+
+    def add_participant(self, row_data: list):
+        """寫入新學員，並在 Participants 快取更新前暫存於 _recent_signups"""
+        self.append_row('Participants', row_data)
+        participant = dict(zip(WORKSHEET_DEFINITIONS['Participants'], (str(v) for v in row_data)))
+        with self._participants_lock:
+            self._recent_signups[participant['email']] = participant
+
+    def _max_participant_id_in_sheet(self):
+        """直接讀取 Participants 的 ID 欄 (不經快取，1 次 API) 取得最大的學員 ID 編號；讀取失敗時拋出例外"""
+        column = self.spreadsheet.values_get(absolute_range_name('Participants', 'A:A')).get('values', [])
+        return max(
+            (int(pid[1:]) for pid in (row[0] for row in column[1:] if row)
+             if pid.startswith('P') and pid[1:].isdigit()),
+            default=0
+        )
+
+    def generate_new_participant_id(self):
+        """預留並返回下一個學員 ID (Pxxx)，1 次 API 呼叫；無法讀取 Participants 時拋出例外"""
+        # 其他 worker 的註冊不會使本程序的快取失效，發號前必須讀取最新的 ID 欄 (註冊頻率低，成本可接受)；
+        # 讀取失敗時寧可註冊失敗，也不以可能過時的計數發出重複 ID
+        try:
+            sheet_max = self._max_participant_id_in_sheet()
         except Exception as e:
-            print(f"寫入 Qr_Tokens 失敗: {e}")
-            raise
+            raise Exception(f"無法讀取 Participants，暫時無法產生學員 ID: {e}")
+        # 在鎖內遞增，確保同一程序的併發註冊不會拿到相同 ID (寫入失敗僅會留下未使用的編號)
+        with self._participant_id_lock:
+            self._max_participant_id = max(self._max_participant_id, sheet_max) + 1
+            return f"P{self._max_participant_id:03d}"
 
-    def consume_qr_token(self, qr_uuid_token: str):
-        """查找並刪除匹配的 QR Token，實現一次性使用。"""
+    # 🆕 報到記錄相關方法:
+    def has_attended(self, participant_id: str, agenda_item_id: str) -> bool:
+        """檢查學員是否已於該議程報到 (查詢記憶體索引，0 次 API 呼叫；索引未載入時查詢 Sheets)"""
+        key = (participant_id, agenda_item_id)
+        with self._attended_lock:
+            if key in self._attended:
+                return True
+            if self._attended_loaded:
+                return False
+        
+        # 索引未載入：只讀取 participant_id 欄 (gspread 的 findall 會下載整張表)，
+        # 再以 batch_get 取回該學員的報到行
         if not self.is_connected:
-            return None
-            
+            return False
         try:
-            sheet = self.get_worksheet('Qr_Tokens')
-            
-            # 1. 查找匹配的 Token (假設 token_uuid 在第 1 欄)
-            cell = sheet.find(qr_uuid_token, in_column=1)
-            
-            # 2. 獲取該行數據
-            row_values = sheet.row_values(cell.row)
-            headers = sheet.row_values(1)
-            token_data = dict(zip(headers, row_values))
-            
-            # 3. 立即刪除該行 (實現一次性消費)
-            sheet.delete_rows(cell.row)
-            
-            # 4. 返回數據，注意 'expires_at' 需要轉換為整數
-            token_data['expires_at'] = int(token_data.get('expires_at', 0))
-            return token_data
-            
-        except gspread.exceptions.CellNotFound:
-            return None
+            sheet = self.get_worksheet('Attendance_Log')
+            participant_col = rowcol_to_a1(1, ATTENDANCE_PARTICIPANT_COLUMN)[:-1]
+            column = self.spreadsheet.values_get(
+                absolute_range_name('Attendance_Log', f"{participant_col}:{participant_col}")
+            ).get('values', [])
+            row_numbers = [i for i, row in enumerate(column, start=1) if i > 1 and row and row[0] == participant_id]
+            if not row_numbers:
+                return False
+            last_col = rowcol_to_a1(1, len(WORKSHEET_DEFINITIONS['Attendance_Log']))[:-1]
+            rows = sheet.batch_get([f"A{r}:{last_col}{r}" for r in row_numbers])
+            attended = any(
+                value_range and len(value_range[0]) >= ATTENDANCE_AGENDA_COLUMN
+                and value_range[0][ATTENDANCE_AGENDA_COLUMN - 1] == agenda_item_id
+                for value_range in rows
+            )
         except Exception as e:
-            print(f"消費 Qr Token 失敗: {e}")
-            return None
-            
+            print(f"查詢報到記錄失敗: {e}")
+            return False
+        if attended:
+            with self._attended_lock:
+                self._attended.add(key)
+        return attended
+
+    def mark_attended(self, participant_id: str, agenda_item_id: str, log_data: list):
+        """寫入報到記錄並更新已報到索引；若已報到則返回 False，不重複寫入"""
+        key = (participant_id, agenda_item_id)
+        with self._attended_lock:
+            if key in self._attended:
+                return False
+            self._attended.add(key)
+            self._recent_marks[key] = time.time()
+        try:
+            if self._journal is None:
+                self.append_row('Attendance_Log', log_data)
+            elif not self._journal_attendance(key, log_data):
+                # 同主機的其他 worker 已記錄此報到 (保留在索引中)
+                return False
+            # 🆕 已寫入本地日誌即確認報到，由 export_attendance_log 批次匯出到 Sheets
+        except Exception:
+            # 寫入失敗時移除索引，讓學員可以重新報到
+            with self._attended_lock:
+                self._attended.discard(key)
+                self._recent_marks.pop(key, None)
+            raise
+        return True
+
     def initialize_system(self, clear_data: bool):
         """執行資料庫初始化邏輯"""
         if not self.is_connected:
@@ -192,59 +556,106 @@ class SheetsManager:
             
         initialized_sheets = []
         
-        # 1. 處理工作表的創建、清空與表頭寫入
-        for title, headers in WORKSHEET_DEFINITIONS.items():
-            try:
-                ws = self.spreadsheet.worksheet(title)
-            except WorksheetNotFound:
-                ws = self.spreadsheet.add_worksheet(title=title, rows="100", cols="20")
-            
-            if clear_data:
-                ws.clear()
-            
-            ws.update([headers], range_name='A1')
-            initialized_sheets.append(title)
-
-
-        # 2. 寫入初始測試數據 (必須在表頭寫入之後)
-        # 初始密碼 'test1234'
-        hashed_password = bcrypt.hashpw('test1234'.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        # 清除資料時一併清除本地日誌，否則先匯出尚未寫入的報到記錄，避免稍後重建已報到索引時遺失
+        if clear_data and self._journal is not None:
+            with self._journal_lock:
+                self._journal.execute("DELETE FROM attendance_journal")
+        else:
+            self.export_attendance_log()
         
-        # --- Admins ---
-        admins_ws = self.spreadsheet.worksheet('Admins')
-        admin_data = [
-            ['1', 'admin', hashed_password, 'SUPER_ADMIN', time.strftime("%Y-%m-%d %H:%M:%S")],
-            ['2', 'staff_01', hashed_password, 'CHECKIN_STAFF', '']
-        ]
-        admins_ws.append_rows(admin_data)
+        # 1. 準備初始測試數據 (寫在表頭之後)
+        # 初始密碼 'test1234'
+        hashed_password = bcrypt.hashpw('test1234'.encode('utf-8'), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode('utf-8')
         
-        # --- Participants (學員登入 hash 也是 'test1234' 的 hash) ---
-        participants_ws = self.spreadsheet.worksheet('Participants')
-        participant_data = [
-            ['P001', '王小明', 'ming@test.com', '0910123456', '科技學院', hashed_password],
-            ['P002', '陳大華', 'hua@test.com', '0920654321', '醫學院', hashed_password]
-        ]
-        participants_ws.append_rows(participant_data)
+        seed_data = {
+            # --- Admins ---
+            'Admins': [
+                ['1', 'admin', hashed_password, 'SUPER_ADMIN', time.strftime("%Y-%m-%d %H:%M:%S")],
+                ['2', 'staff_01', hashed_password, 'CHECKIN_STAFF', '']
+            ],
+            # --- Participants (學員登入 hash 也是 'test1234' 的 hash) ---
+            'Participants': [
+                ['P001', '王小明', 'ming@test.com', '0910123456', '科技學院', hashed_password],
+                ['P002', '陳大華', 'hua@test.com', '0920654321', '醫學院', hashed_password]
+            ],
+            # --- Events, Agenda_Items, Registration 初始數據 ---
+            'Events': [['E001', '2026 年度學術研討會', '學術界年度盛事', '300', 'TRUE']],
+            'Agenda_Items': [
+                ['A101', 'E001', '開幕式與專題演講', '2026-01-10T09:00:00+08:00', '2026-01-10T10:30:00+08:00', '國際廳', '30'],
+                ['A102', 'E001', '分組討論：AI應用', '2026-01-10T11:00:00+08:00', '2026-01-10T12:00:00+08:00', 'A203會議室', '15']
+            ],
+            'Registration': [
+                ['1', 'P001', 'E001', time.strftime("%Y-%m-%d"), 'TRUE'],
+                ['2', 'P002', 'E001', time.strftime("%Y-%m-%d"), 'TRUE']
+            ],
+        }
         
-        # --- Events, Agenda_Items, Registration 初始數據 ---
-        events_ws = self.spreadsheet.worksheet('Events')
-        events_ws.append_rows([['E001', '2026 年度學術研討會', '學術界年度盛事', '300', 'TRUE']])
+        # 2. 一次取得所有現有工作表 (1 次 API)
+        self._refresh_worksheets()
+        existing_sheets = self._worksheets
         
-        agenda_ws = self.spreadsheet.worksheet('Agenda_Items')
-        agenda_ws.append_rows([
-            ['A101', 'E001', '開幕式與專題演講', '2026-01-10T09:00:00+08:00', '2026-01-10T10:30:00+08:00', '國際廳', '30'],
-            ['A102', 'E001', '分組討論：AI應用', '2026-01-10T11:00:00+08:00', '2026-01-10T12:00:00+08:00', 'A203會議室', '15']
-        ])
+        # 未清空時，初始數據需接在現有數據之後 (與原先 append_rows 行為一致)：
+        # 以單一 values.batchGet 讀取現有各表 A 欄以計算起始行 (新工作表從第 2 行開始)
+        next_rows = {title: 2 for title in seed_data}
+        if not clear_data:
+            existing_seeded = [title for title in seed_data if title in existing_sheets]
+            if existing_seeded:
+                response = self.spreadsheet.values_batch_get(
+                    [absolute_range_name(title, 'A:A') for title in existing_seeded]
+                )
+                for title, value_range in zip(existing_seeded, response.get('valueRanges', [])):
+                    next_rows[title] = max(len(value_range.get('values', [])), 1) + 1
         
-        registration_ws = self.spreadsheet.worksheet('Registration')
-        registration_ws.append_rows([
-            ['1', 'P001', 'E001', time.strftime("%Y-%m-%d"), 'TRUE'],
-            ['2', 'P002', 'E001', time.strftime("%Y-%m-%d"), 'TRUE']
-        ])
+        # 3. 新增工作表、清空、擴充網格與寫入表頭合併為單一 spreadsheets.batchUpdate (1 次 API)
+        #    新工作表自行指定 sheetId，同一批次中的 updateCells 才能引用
+        sheet_ids = {title: ws.id for title, ws in existing_sheets.items()}
+        next_sheet_id = max(sheet_ids.values(), default=0) + 1
+        structure_requests = []
+        for title in WORKSHEET_DEFINITIONS:
+            if title in sheet_ids:
+                continue
+            sheet_ids[title] = next_sheet_id
+            next_sheet_id += 1
+            structure_requests.append({"addSheet": {"properties": {
+                "sheetId": sheet_ids[title], "title": title,
+                "gridProperties": {"rowCount": 100, "columnCount": 20}
+            }}})
+        for title in existing_sheets:
+            if title not in WORKSHEET_DEFINITIONS:
+                continue
+            if clear_data:
+                # 不帶 rows 的 updateCells 會清空整張工作表的值 (等同 ws.clear())
+                structure_requests.append({"updateCells": {
+                    "range": {"sheetId": sheet_ids[title]}, "fields": "userEnteredValue"
+                }})
+            elif title in seed_data:
+                # 初始數據會接在現有數據之後：先擴充網格行數，避免寫入超出範圍 (append_rows 原本會自動擴充)
+                structure_requests.append({"appendDimension": {
+                    "sheetId": sheet_ids[title], "dimension": "ROWS", "length": len(seed_data[title])
+                }})
+        for title, headers in WORKSHEET_DEFINITIONS.items():
+            structure_requests.append({"updateCells": {
+                "rows": [{"values": [{"userEnteredValue": {"stringValue": h}} for h in headers]}],
+                "fields": "userEnteredValue",
+                "start": {"sheetId": sheet_ids[title], "rowIndex": 0, "columnIndex": 0}
+            }})
+            initialized_sheets.append(title)
+        self.spreadsheet.batch_update({"requests": structure_requests})
+        if any("addSheet" in r for r in structure_requests):
+            # 有新增工作表時重新載入工作表物件快取
+            self._refresh_worksheets()
+
+        # 4. 所有初始數據合併為單一 values.batchUpdate 寫入 (1 次 API)
+        data = [
+            {"range": absolute_range_name(title, f"A{next_rows[title]}"), "values": rows}
+            for title, rows in seed_data.items()
+        ]
+        self.spreadsheet.values_batch_update({"valueInputOption": "RAW", "data": data})
         
         # Qr_Tokens 不需要初始數據
 
-        return initialized_sheets
+        # 所有工作表內容已變更，清除讀取快取並重新建立記憶體索引
+        self.invalidate_cache()
+        self._load_indexes()
 
-# 實例化 SheetsManager
-sheets_manager = SheetsManager()
+        return initialized_sheets